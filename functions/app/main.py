@@ -21,20 +21,26 @@ import base64
 import os
 import re
 import csv
+import functools
+import hashlib
 import io
+import json
 import tempfile
 import ghostscript
+import numpy as np
+import pandas as pd
 import locale
 import glob
 import time
-
-from pydub import AudioSegment
+from concurrent.futures import ThreadPoolExecutor
 
 from google.cloud import storage
 from google.cloud import vision
 from google.cloud import texttospeech
 from google.cloud import automl_v1beta1 as automl
 from google.protobuf import json_format
+from google.api_core import exceptions
+from google.api_core import retry
 
 # generate PNGs for each page and labeled CSV for annotation
 ANNOTATION_MODE = False
@@ -47,6 +53,36 @@ model_display_name = "<YOUR MODEL DISPLAY NAME>"
 SECTION_BREAK = 2  # sec
 CAPTION_BREAK = 1.5  # sec
 
+# number of pages in each OCR output file
+OCR_BATCH_SIZE = 100
+
+# max number of concurrent TTS requests (keep it low to avoid quota errors)
+TTS_MAX_WORKERS = 8
+
+# retry TTS requests only on transient errors (429, 500, 503)
+TTS_RETRY = retry.Retry(
+    predicate=retry.if_transient_error,
+    initial=0.5,
+    maximum=8.0,
+    multiplier=2.0,
+    deadline=60.0,
+)
+
+# GCS folder for caching MP3 files by the hash of TTS requests
+TTS_CACHE_PREFIX = "tts-cache/"
+
+# max number of concurrent GCS transfers
+GCS_MAX_WORKERS = 16
+
+# max number of retries for getting the triggered blob
+GET_BLOB_RETRIES = 5
+
+# max number of source blobs for a GCS compose request
+MAX_COMPOSE_SOURCES = 32
+
+# max number of requests in a GCS batch request
+MAX_BATCH_SIZE = 100
+
 # prediction labels
 LABEL_BODY = "body"
 LABEL_HEADER = "header"
@@ -56,24 +92,50 @@ FEATURE_CSV_HEADER = (
     "id,text,chars,width,height,area,char_size,pos_x,pos_y,aspect,layout"
 )
 
-# ML API clients
+# text cleanup
+URL_PATTERN = re.compile(r"https?://[\w/:%#$&?()~.=+\-]+")
+SSML_ESCAPE_TABLE = str.maketrans("", "", "<")  # remove all '<'s for SSML
+PERIODS = frozenset(".。」）)”")  # chars that end a sentence
+
+# ML API clients (created on first use as each invocation needs only some)
 project_id = os.environ["GCP_PROJECT"]
-vision_client = vision.ImageAnnotatorClient()
 storage_client = storage.Client()
-speech_client = texttospeech.TextToSpeechClient()
-automl_client = automl.TablesClient(project=project_id, region=compute_region)
+
+
+@functools.lru_cache(maxsize=None)
+def get_vision_client():
+    return vision.ImageAnnotatorClient()
+
+
+@functools.lru_cache(maxsize=None)
+def get_speech_client():
+    return texttospeech.TextToSpeechClient()
+
+
+@functools.lru_cache(maxsize=None)
+def get_automl_client():
+    return automl.TablesClient(project=project_id, region=compute_region)
 
 
 def p2a_gcs_trigger(file, context):
 
-    # get bucket and blob
+    # ignore the TTS cache files
     file_name = file["name"]
-    bucket = None
+    if file_name.startswith(TTS_CACHE_PREFIX):
+        return
+
+    # get bucket and blob
+    bucket = storage_client.bucket(file["bucket"])
     file_blob = None
-    while bucket == None or file_blob == None:  # retry
-        bucket = storage_client.get_bucket(file["bucket"])
+    for i in range(GET_BLOB_RETRIES):  # retry with exponential backoff
         file_blob = bucket.get_blob(file_name)
-        time.sleep(1)
+        if file_blob:
+            break
+        if i < GET_BLOB_RETRIES - 1:
+            time.sleep(0.1 * 2 ** i)
+    if not file_blob:
+        print("File not found: {}".format(file_name))
+        return
 
     # OCR
     if file_name.lower().endswith(".pdf"):
@@ -111,15 +173,21 @@ def p2a_ocr_pdf(bucket, pdf_blob):
     gcs_dest_uri = "gs://{}/{}".format(bucket.name, pdf_id + ".")
     gcs_destination = vision.types.GcsDestination(uri=gcs_dest_uri)
     output_config = vision.types.OutputConfig(
-        gcs_destination=gcs_destination, batch_size=100
+        gcs_destination=gcs_destination, batch_size=OCR_BATCH_SIZE
     )
 
     # call the API
     async_request = vision.types.AsyncAnnotateFileRequest(
         features=[feature], input_config=input_config, output_config=output_config
     )
-    async_response = vision_client.async_batch_annotate_files(requests=[async_request])
-    print("Started OCR for file {}".format(pdf_blob.name))
+    async_response = get_vision_client().async_batch_annotate_files(
+        requests=[async_request]
+    )
+    print(
+        "Started OCR for file {} (operation: {})".format(
+            pdf_blob.name, async_response.operation.name
+        )
+    )
 
     # convert PDF to PNG files for annotation
     if ANNOTATION_MODE:
@@ -134,13 +202,13 @@ def p2a_predict(bucket, json_blob):
     first_page = int(m.group(2))
 
     # read the json file
-    csv = FEATURE_CSV_HEADER + "\n"
-    csv += build_feature_csv(json_blob, pdf_id, first_page)
+    feature_csv = FEATURE_CSV_HEADER + "\n"
+    feature_csv += build_feature_csv(json_blob, pdf_id, first_page)
 
     # save the feature CSV file for prediction
     feature_file_name = "{}-{:03}-features.csv".format(pdf_id, first_page)
     feature_blob = bucket.blob(feature_file_name)
-    feature_blob.upload_from_string(csv)
+    feature_blob.upload_from_string(feature_csv)
     print("Feature CSV file saved: {}".format(feature_file_name))
     json_blob.delete()
 
@@ -148,99 +216,112 @@ def p2a_predict(bucket, json_blob):
     gcs_input_uris = ["gs://{}/{}".format(bucket.name, feature_file_name)]
     gcs_output_uri = "gs://{}".format(bucket.name)
 
-    # Query model
-    print("Started AutoML batch prediction for {}".format(feature_file_name))
-    response = automl_client.batch_predict(
+    # Query model (the results trigger p2a_generate_speech/p2a_generate_labels)
+    response = get_automl_client().batch_predict(
         gcs_input_uris=gcs_input_uris,
         gcs_output_uri_prefix=gcs_output_uri,
         model_display_name=model_display_name,
     )
-    response.result()
-    print("Ended AutoML batch prediction for {}".format(feature_file_name))
-    if not ANNOTATION_MODE:
-        feature_blob.delete()
+    print(
+        "Started AutoML batch prediction for {} (operation: {})".format(
+            feature_file_name, response.operation.name
+        )
+    )
 
 
 def build_feature_csv(json_blob, pdf_id, first_page):
 
-    # parse json
-    json_string = json_blob.download_as_string()
-    json_response = json_format.Parse(json_string, vision.types.AnnotateFileResponse())
+    # parse json (without the duplicate key check hook of json_format.Parse())
+    json_dict = json.loads(json_blob.download_as_string())
+    json_response = json_format.ParseDict(
+        json_dict, vision.types.AnnotateFileResponse()
+    )
 
-    # covert the json file to a bag of CSV lines
-    csv = ""
+    # collect paras of all pages
+    para_ids = []
+    paras = []
     page_count = first_page
     for resp in json_response.responses:
         para_count = 0
         for page in resp.full_text_annotation.pages:
-
-            # collect para features for the page
-            page_features = []
             for block in page.blocks:
                 if str(block.block_type) != "1":  # process only TEXT blocks
                     continue
                 for para in block.paragraphs:
-                    para_id = "{}-{:03}-{:03}".format(pdf_id, page_count, para_count)
-                    f = extract_paragraph_feature(para_id, para)
-                    page_features.append(f)
+                    para_ids.append(
+                        "{}-{:03}-{:03}".format(pdf_id, page_count, para_count)
+                    )
+                    paras.append(para)
                     para_count += 1
-
-            # output to csv
-            for f in page_features:
-                csv += '{},"{}",{},{:.6f},{:.6f},{:.6f},{:.6f},{:.6f},{:.6f},{:.6f},{}\n'.format(
-                    f["para_id"],
-                    f["text"],
-                    f["chars"],
-                    f["width"],
-                    f["height"],
-                    f["area"],
-                    f["char_size"],
-                    f["pos_x"],
-                    f["pos_y"],
-                    f["aspect"],
-                    f["layout"],
-                )
-
         page_count += 1
-    return csv
+    if not paras:
+        return ""
+
+    # extract para features as columns
+    texts = [extract_paragraph_text(para) for para in paras]
+    f = compute_geom_features(paras, texts)
+    float_columns = [
+        np.char.mod("%.6f", f[name])
+        for name in ["width", "height", "area", "char_size", "pos_x", "pos_y", "aspect"]
+    ]
+
+    # covert the columns to a bag of CSV lines
+    csv_file = io.StringIO()
+    writer = csv.writer(csv_file, lineterminator="\n")
+    writer.writerows(zip(para_ids, texts, f["chars"], *float_columns, f["layout"]))
+    return csv_file.getvalue()
 
 
-def extract_paragraph_feature(para_id, para):
+def extract_paragraph_text(para):
 
     # collect text
-    text = ""
+    parts = []
     for word in para.words:
         for symbol in word.symbols:
-            text += symbol.text
+            parts.append(symbol.text)
             if hasattr(symbol.property, "detected_break"):
                 break_type = symbol.property.detected_break.type
                 if str(break_type) == "1":
-                    text += " "  # if the break is SPACE
+                    parts.append(" ")  # if the break is SPACE
+    text = "".join(parts)
 
     # remove double quotes
     text = text.replace('"', "")
 
     # remove URLs
-    text = re.sub("https?://[\w/:%#\$&\?\(\)~\.=\+\-]+", "", text)
+    text = URL_PATTERN.sub("", text)
+
+    return text
+
+
+def compute_geom_features(paras, texts):
+
+    # bounding box vertices of all paras as (num_paras, 4, 2) array
+    vertices = np.array(
+        [
+            [(v.x, v.y) for v in para.bounding_box.normalized_vertices]
+            for para in paras
+        ],
+        dtype=np.float64,
+    )
 
     # extract bounding box features
-    x_list = []
-    y_list = []
-    for v in para.bounding_box.normalized_vertices:
-        x_list.append(v.x)
-        y_list.append(v.y)
+    mins = vertices.min(axis=1)
+    maxs = vertices.max(axis=1)
     f = {}
-    f["para_id"] = para_id
-    f["text"] = text
-    f["width"] = max(x_list) - min(x_list)
-    f["height"] = max(y_list) - min(y_list)
+    f["width"] = maxs[:, 0] - mins[:, 0]
+    f["height"] = maxs[:, 1] - mins[:, 1]
     f["area"] = f["width"] * f["height"]
-    f["chars"] = len(text)
-    f["char_size"] = f["area"] / f["chars"] if f["chars"] > 0 else 0
-    f["pos_x"] = (f["width"] / 2.0) + min(x_list)
-    f["pos_y"] = (f["height"] / 2.0) + min(y_list)
-    f["aspect"] = f["width"] / f["height"] if f["height"] > 0 else 0
-    f["layout"] = "h" if f["aspect"] > 1 else "v"
+    f["chars"] = np.array([len(text) for text in texts])
+    f["char_size"] = np.divide(
+        f["area"], f["chars"], out=np.zeros_like(f["area"]), where=f["chars"] > 0
+    )
+    f["pos_x"] = (f["width"] / 2.0) + mins[:, 0]
+    f["pos_y"] = (f["height"] / 2.0) + mins[:, 1]
+    f["aspect"] = np.divide(
+        f["width"], f["height"], out=np.zeros_like(f["width"]), where=f["height"] > 0
+    )
+    f["layout"] = np.where(f["aspect"] > 1, "h", "v")
 
     return f
 
@@ -252,6 +333,12 @@ def p2a_generate_speech(bucket, csv_blob):
         bucket, csv_blob
     )
 
+    # delete the feature CSV file (not needed after the prediction)
+    try:
+        bucket.delete_blob(batch_id + "-features.csv")
+    except exceptions.NotFound:
+        pass
+
     # generate mp3 files with the parsed results
     mp3_blob_list = generate_mp3_files(bucket, sorted_ids, text_dict, label_dict)
 
@@ -261,87 +348,72 @@ def p2a_generate_speech(bucket, csv_blob):
     # delete prediction result (tables_1.csv) files
     folder_name = re.sub("/.*.csv", "", csv_blob.name)
     folder_blobs = storage_client.list_blobs(bucket, prefix=folder_name)
-    for b in folder_blobs:
-        b.delete()
+    delete_blobs(bucket, folder_blobs)
 
 
 def parse_prediction_results(bucket, csv_blob):
     # parse CSV
-    csv_string = csv_blob.download_as_string().decode("utf-8")
-    csv_file = io.StringIO(csv_string)
-    reader = csv.DictReader(csv_file)
-    text_dict = {}
-    label_dict = {}
-    for row in reader:
-
-        # build text_dict
-        id = row["id"]
-        text = row["text"]
-        text = text.replace("<", "")  # remove all '<'s for escaping in SSML
-        text_dict[id] = text
-
-        # build label_dict
-        sc_other = float(row["label_other_score"])
-        sc_body = float(row["label_body_score"])
-        sc_caption = float(row["label_caption_score"])
-        sc_header = float(row["label_header_score"])
-        #        if sc_other > 0.7:
-        if sc_other > max(sc_header, sc_body, sc_caption):
-            label_dict[id] = LABEL_OTHER
-        elif sc_header > max(sc_body, sc_caption):
-            label_dict[id] = LABEL_HEADER
-        elif sc_caption > sc_body:
-            label_dict[id] = LABEL_CAPTION
-        else:
-            label_dict[id] = LABEL_BODY
+    df = pd.read_csv(
+        io.BytesIO(csv_blob.download_as_string()),
+        dtype={"id": str, "text": str},
+        keep_default_na=False,
+    )
+
+    # build text_dict
+    texts = df["text"].str.translate(SSML_ESCAPE_TABLE)
+    text_dict = dict(zip(df["id"], texts))
+
+    # build label_dict (on ties, the earlier label in the list wins)
+    labels = [LABEL_BODY, LABEL_CAPTION, LABEL_HEADER, LABEL_OTHER]
+    scores = df[["label_{}_score".format(l) for l in labels]].to_numpy()
+    label_dict = dict(zip(df["id"], np.array(labels)[scores.argmax(axis=1)].tolist()))
+
+    # sort by id
     sorted_ids = sorted(text_dict.keys())
     first_id = sorted_ids[0]
 
     # remove the OTHER paras
-    others = ""
-    for id in sorted_ids:
-        if label_dict[id] == LABEL_OTHER:
-            others += text_dict[id] + " "
-            sorted_ids.remove(id)
+    sorted_ids = [id for id in sorted_ids if label_dict[id] != LABEL_OTHER]
 
     # merging subsequent paragraphs
-    last_id = None
-    period_pattern = re.compile(r"^.*[.。」）)”]$")
+    merged_ids = []
     for id in sorted_ids:
-        if last_id:
+        if merged_ids:
+            last_id = merged_ids[-1]
             is_bodypairs = (
                 label_dict[id] == LABEL_BODY and label_dict[last_id] == LABEL_BODY
             )
             is_captpairs = (
                 label_dict[id] == LABEL_CAPTION and label_dict[last_id] == LABEL_CAPTION
             )
-            is_lastbody_nopediod = not period_pattern.match(text_dict[last_id])
+            is_lastbody_nopediod = text_dict[last_id][-1:] not in PERIODS
             if (is_bodypairs and is_lastbody_nopediod) or is_captpairs:
                 text_dict[id] = text_dict[last_id] + text_dict[id]
-                sorted_ids.remove(last_id)
-        last_id = id
+                merged_ids.pop()
+        merged_ids.append(id)
+    sorted_ids = merged_ids
 
-    # get batch_id (pdf id + the first page number)
-    m = re.match("(.*-[0-9]+)-.*", first_id)
-    batch_id = m.group(1)
+    # get batch_id (pdf id + the first page number of the OCR output file)
+    m = re.match("(.*)-([0-9]+)-.*", first_id)
+    first_page = (int(m.group(2)) - 1) // OCR_BATCH_SIZE * OCR_BATCH_SIZE + 1
+    batch_id = "{}-{:03}".format(m.group(1), first_page)
 
     return batch_id, sorted_ids, text_dict, label_dict
 
 
 def generate_mp3_files(bucket, sorted_ids, text_dict, label_dict):
 
-    # generate speech for each <4500 chars
+    # build SSML chunks for generating speech
     ssml = ""
     section_break = '<break time="{}s"/>'.format(SECTION_BREAK)
     caption_break = '<break time="{}s"/>'.format(CAPTION_BREAK)
-    mp3_blob_list = []
+    ssml_chunks = []
     prev_id = None
     for id in sorted_ids:
 
         # split as chunks with <4500 chars each
         if len(ssml) + len(text_dict[id]) > 4500:
-            mp3_blob = generate_mp3_for_ssml(bucket, prev_id, ssml)
-            mp3_blob_list.append(mp3_blob)
+            ssml_chunks.append((prev_id, ssml))
             ssml = ""
 
         # add SSML tags based on the label
@@ -354,13 +426,24 @@ def generate_mp3_files(bucket, sorted_ids, text_dict, label_dict):
 
         prev_id = id
 
-    # generate speech for the remaining
-    mp3_blob = generate_mp3_for_ssml(bucket, prev_id, ssml)
-    mp3_blob_list.append(mp3_blob)
+    # add the remaining
+    ssml_chunks.append((prev_id, ssml))
+
+    # generate speech for each chunk in parallel (map() keeps the order)
+    # and fill the TTS cache in background (done before the mp3 files merged)
+    get_speech_client()  # create the client before sharing it among threads
+    with ThreadPoolExecutor(max_workers=GCS_MAX_WORKERS) as cache_executor:
+        with ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS) as executor:
+            mp3_blob_list = list(
+                executor.map(
+                    lambda c: generate_mp3_for_ssml(bucket, *c, cache_executor),
+                    ssml_chunks,
+                )
+            )
     return mp3_blob_list
 
 
-def generate_mp3_for_ssml(bucket, id, ssml):
+def generate_mp3_for_ssml(bucket, id, ssml, cache_executor):
 
     # set text and configs
     ssml = "<speak>\n" + ssml + "</speak>\n"
@@ -372,50 +455,91 @@ def generate_mp3_for_ssml(bucket, id, ssml):
         audio_encoding=texttospeech.enums.AudioEncoding.MP3, speaking_rate=1.5
     )
 
-    # generate speech
+    # reuse the cached MP3 file for the same request if any
+    mp3_file_name = id + ".mp3"
+    cache_key = hashlib.sha1(
+        synthesis_input.SerializeToString()
+        + voice.SerializeToString()
+        + audio_config.SerializeToString()
+    ).hexdigest()
+    cache_file_name = TTS_CACHE_PREFIX + cache_key + ".mp3"
     try:
-        response = speech_client.synthesize_speech(synthesis_input, voice, audio_config)
-    except Exception as e:
-        print("Retrying speech generation...")  # sometimes the api returns 500 error
-        response = speech_client.synthesize_speech(synthesis_input, voice, audio_config)
+        mp3_blob = bucket.copy_blob(bucket.blob(cache_file_name), bucket, mp3_file_name)
+        print("MP3 file saved from cache: {}".format(mp3_file_name))
+        return mp3_blob
+    except exceptions.NotFound:
+        pass
+
+    # generate speech (sometimes the api returns 500 error)
+    response = get_speech_client().synthesize_speech(
+        synthesis_input, voice, audio_config, retry=TTS_RETRY
+    )
 
-    # save a MP3 file and delete the text file
-    mp3_file_name = id + ".mp3"
+    # save a MP3 file and copy it to the cache in background
     mp3_blob = bucket.blob(mp3_file_name)
     mp3_blob.upload_from_string(response.audio_content, content_type="audio/mpeg")
     print("MP3 file saved: {}".format(mp3_file_name))
+    cache_executor.submit(save_mp3_to_cache, bucket, mp3_blob, cache_file_name)
     return mp3_blob
 
 
+def save_mp3_to_cache(bucket, mp3_blob, cache_file_name):
+
+    # the cache is optional, so do not fail the run on errors
+    try:
+        bucket.copy_blob(mp3_blob, bucket, cache_file_name)
+    except Exception as e:
+        print("Failed to save {} to the cache: {}".format(cache_file_name, e))
+
+
 def merge_mp3_files(bucket, batch_id, mp3_blob_list):
 
-    # merge saved mp3 files
+    # merge saved mp3 files on GCS (MP3 frames can be simply concatenated)
     print("Started merging mp3 files for {}".format(batch_id))
-    merged_mp3 = None
-    for mp3_blob in mp3_blob_list:
-        mp3_file = io.BytesIO(mp3_blob.download_as_string())
-        mp3_data = AudioSegment.from_file(mp3_file, format="mp3")
-        if merged_mp3:
-            merged_mp3 += mp3_data
-        else:
-            merged_mp3 = mp3_data
-
-    # save the merged mp3 file
     merged_mp3_file_name = (
         re.sub("[0-9][0-9]$", "", batch_id) + ".mp3"
     )  # 'foo-101' -> 'foo-1.mp3'
-    merged_mp3_file_path = tempfile.gettempdir() + "/" + merged_mp3_file_name
-    merged_mp3.export(merged_mp3_file_path, format="mp3")
     merged_mp3_blob = bucket.blob(merged_mp3_file_name)
-    merged_mp3_blob.upload_from_filename(
-        merged_mp3_file_path, content_type="audio/mpeg"
-    )
+    merged_mp3_blob.content_type = "audio/mpeg"
+    compose_blobs(bucket, merged_mp3_blob, mp3_blob_list)
 
     # delete mp3 files
-    bucket.delete_blobs(mp3_blob_list)
+    delete_blobs(bucket, mp3_blob_list)
     print("Ended merging mp3 files: {}".format(merged_mp3_file_name))
 
 
+def compose_blobs(bucket, dest_blob, source_blobs, level=0):
+
+    # GCS can compose up to 32 blobs at once
+    if len(source_blobs) <= MAX_COMPOSE_SOURCES:
+        dest_blob.compose(source_blobs)
+        return
+
+    # compose each group into an intermediate blob, then compose them
+    groups = [
+        source_blobs[i : i + MAX_COMPOSE_SOURCES]
+        for i in range(0, len(source_blobs), MAX_COMPOSE_SOURCES)
+    ]
+    part_blobs = []
+    for i in range(len(groups)):
+        part_blob = bucket.blob("{}.part{}-{:03}".format(dest_blob.name, level, i))
+        part_blob.content_type = dest_blob.content_type
+        part_blobs.append(part_blob)
+    with ThreadPoolExecutor(max_workers=GCS_MAX_WORKERS) as executor:
+        list(executor.map(lambda p: p[0].compose(p[1]), zip(part_blobs, groups)))
+    compose_blobs(bucket, dest_blob, part_blobs, level + 1)
+    delete_blobs(bucket, part_blobs)
+
+
+def delete_blobs(bucket, blobs):
+
+    # delete blobs with batch requests
+    blobs = list(blobs)
+    for i in range(0, len(blobs), MAX_BATCH_SIZE):
+        with storage_client.batch():
+            bucket.delete_blobs(blobs[i : i + MAX_BATCH_SIZE])
+
+
 #
 # Annotation tool functions
 #
@@ -430,21 +554,24 @@ def p2a_generate_labels(bucket, automl_csv_blob):
 
     # open features CSV
     features_blob = bucket.get_blob(batch_id + "-features.csv")
-    features_string = features_blob.download_as_string().decode("utf-8")
-    csv = ""
+    features_file = io.TextIOWrapper(
+        io.BytesIO(features_blob.download_as_string()), encoding="utf-8", newline="\n"
+    )
+    label_lines = []
     if batch_id.endswith("001"):  # add csv header only for the first csv file
-        csv += FEATURE_CSV_HEADER + ",label\n"
-    for l in features_string.split("\n"):
+        label_lines.append(FEATURE_CSV_HEADER + ",label\n")
+    for l in features_file:
+        l = l.rstrip("\n")
         m = re.match("^([^,]*-[0-9]+-[0-9]+),.*$", l)
         if m:
             id = m.group(1)
             label = label_dict[id]
-            csv += l + "," + label + "\n"
+            label_lines.append(l + "," + label + "\n")
 
     # save the labels CSV file
     labels_file_name = batch_id + "-labels.csv"
     labels_blob = bucket.blob(labels_file_name)
-    labels_blob.upload_from_string(csv)
+    labels_blob.upload_from_string("".join(label_lines))
     labels_blob.make_public()
     print("Predicted results saved: {}".format(labels_file_name))
     features_blob.delete()
@@ -452,16 +579,15 @@ def p2a_generate_labels(bucket, automl_csv_blob):
     # delete prediction result (tables_1.csv) files
     folder_name = re.sub("/.*.csv", "", automl_csv_blob.name)
     folder_blobs = storage_client.list_blobs(bucket, prefix=folder_name)
-    for b in folder_blobs:
-        b.delete()
+    delete_blobs(bucket, folder_blobs)
 
 
 def convert_pdf2png(bucket, pdf_blob):
 
     # download the PDF file to a temp file
     print("Downloading PDF: {}".format(pdf_blob.name))
-    _, pdf_file_name = tempfile.mkstemp()
-    with open(pdf_file_name, "w+b") as pdf_file:
+    pdf_fd, pdf_file_name = tempfile.mkstemp()
+    with os.fdopen(pdf_fd, "w+b") as pdf_file:
         pdf_blob.download_to_file(pdf_file)
 
     # convert the PDF to PNGs
@@ -478,14 +604,28 @@ def convert_pdf2png(bucket, pdf_blob):
     ]
     encoding = locale.getpreferredencoding()
     args = [a.encode(encoding) for a in args]
-    ghostscript.Ghostscript(*args)
+    try:
+        ghostscript.Ghostscript(*args)
+    finally:
+        os.remove(pdf_file_name)  # /tmp is in memory on Cloud Functions
 
     # save the PNGs on GCS
     print("Saving PNGs for {}".format(pdf_blob.name))
-    for f in glob.glob(png_tempdir + "/*"):
-        png_blob = bucket.blob(pdf_prefix + "-images/" + os.path.split(f)[1])
-        png_blob.upload_from_filename(f, content_type="image/png")
-        png_blob.make_public()
-        os.remove(f)
+    with ThreadPoolExecutor(max_workers=GCS_MAX_WORKERS) as executor:
+        list(
+            executor.map(
+                lambda f: save_png(bucket, pdf_prefix, f),
+                glob.glob(png_tempdir + "/*"),
+            )
+        )
+    os.rmdir(png_tempdir)
     print("Ended converting PDF to PNGs for {}".format(pdf_blob.name))
-    os.remove(pdf_file_name)
+
+
+def save_png(bucket, pdf_prefix, png_file_name):
+
+    # upload a PNG file as a public blob and delete the local file
+    png_blob = bucket.blob(pdf_prefix + "-images/" + os.path.split(png_file_name)[1])
+    png_blob.upload_from_filename(png_file_name, content_type="image/png")
+    png_blob.make_public()
+    os.remove(png_file_name)